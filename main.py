@@ -3,17 +3,34 @@
 支持胶囊创建、查询、搜索、碰撞检测、DATM评分
 """
 from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, field_validator
+from typing import Optional, List, Dict, Any, Iterator, Tuple
 import sqlite3
 import os
+import time
+import functools
+import heapq
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-import json
-import hashlib
-import random
+import math
+import re
+import secrets
+import struct
+import numpy as np
+import orjson
 
 # ===================== 配置 =====================
-DB_PATH = "/Users/wanyview/clawd/capsule_service/capsules.db"
+DB_PATH = os.environ.get("CAPSULE_DB_PATH", "/Users/wanyview/clawd/capsule_service/capsules.db")
+SCHEMA_VERSION = 7
+DATM_POOL_SIZE = 4096
+CACHE_TTL_SECONDS = 60
+COLLISION_BATCH_SIZE = 4096  # 碰撞候选按批读取
+COLLISION_VECTOR_MIN_ROWS = 256  # 一批候选达到该数量时改用 NumPy 向量化计分
+CACHE_MAX_ENTRIES = 1024
+TAG_SEP = "\x1f"  # 标签分隔符（ASCII单元分隔符，由 check_tags 禁止出现在标签中）
 app = FastAPI(title="Kai Capsule Service", version="2.0.0")
 
 # ===================== 数据库 =====================
@@ -23,51 +40,191 @@ def get_db():
     """获取数据库连接（线程安全）"""
     global _db_conn
     if _db_conn is None:
-        _db_conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        _db_conn.row_factory = sqlite3.Row
+        # 自动提交模式：读操作不开隐式事务，写操作由 transaction() 显式开启
+        # 行以普通元组返回，按列位置解包
+        _db_conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        _db_conn.execute("PRAGMA journal_mode=WAL")
+        _db_conn.execute("PRAGMA synchronous=NORMAL")
+        _db_conn.execute("PRAGMA temp_store=MEMORY")
+        _db_conn.execute("PRAGMA cache_size=-64000")
     return _db_conn
 
+# 已提交的标签词表缓存（tag -> id），只作读取加速，编号以数据库为准
+_tag_vocab: Dict[str, int] = {}
+
+@contextmanager
+def transaction(conn):
+    """显式写事务：BEGIN IMMEDIATE ... COMMIT，出错回滚"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        # 回滚会撤销本事务登记的新标签，内存词表随之作废
+        _tag_vocab.clear()
+        raise
+    conn.execute("COMMIT")
+
+def load_tag_vocab(conn):
+    """加载标签词表到内存"""
+    _tag_vocab.clear()
+    _tag_vocab.update(conn.execute("SELECT tag, id FROM tag_vocab").fetchall())
+
+def encode_tag_ids(conn, tags: List[str]) -> bytes:
+    """把标签集合编码为词表编号，新标签登记到词表（须在写事务内调用，随事务一起提交）"""
+    # 存为升序 uint32 小端编号：每行大小只与自身标签数有关，不随词表增长
+    # 新编号由 SQLite 分配：写事务持有写锁，多个进程共用一个库时也不会把同一编号分给不同标签
+    ids = set()
+    for tag in tags:
+        tag_id = _tag_vocab.get(tag)
+        if tag_id is None:
+            row = conn.execute("SELECT id FROM tag_vocab WHERE tag = ?", (tag,)).fetchone()
+            if row is None:
+                row = conn.execute("INSERT INTO tag_vocab (tag) VALUES (?) RETURNING id", (tag,)).fetchone()
+            tag_id = _tag_vocab[tag] = row[0]
+        ids.add(tag_id)
+    return struct.pack(f"<{len(ids)}I", *sorted(ids))
+
+def decode_tag_ids(blob: bytes) -> Tuple[int, ...]:
+    """tag_ids BLOB 还原为标签编号"""
+    return struct.unpack(f"<{len(blob) // 4}I", blob)
+
+def backfill_tag_ids(conn):
+    """按 capsule_tags 重新计算全部胶囊的 tag_ids"""
+    rows = conn.execute("SELECT capsule_id, tag FROM capsule_tags ORDER BY capsule_id").fetchall()
+    tags_by_id: Dict[str, List[str]] = {}
+    for capsule_id, tag in rows:
+        tags_by_id.setdefault(capsule_id, []).append(tag)
+    conn.execute("UPDATE capsules SET tag_ids = X''")
+    conn.executemany(
+        "UPDATE capsules SET tag_ids = ? WHERE id = ?",
+        [(encode_tag_ids(conn, tags), capsule_id) for capsule_id, tags in tags_by_id.items()]
+    )
+
 def init_db():
     """初始化数据库"""
     conn = get_db()
-    cursor = conn.cursor()
-    
-    # 知识胶囊表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS capsules (
-            id TEXT PRIMARY KEY,
-            title TEXT NOT NULL,
-            content TEXT NOT NULL,
-            source TEXT,
-            domain TEXT,
-            tags TEXT,
-            datm_score REAL,
-            author TEXT,
-            created_at TEXT,
-            updated_at TEXT,
-            metadata TEXT
-        )
-    ''')
-    
-    # 胶囊碰撞记录表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS collisions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            capsule_a_id TEXT,
-            capsule_b_id TEXT,
-            collision_type TEXT,
-            score REAL,
-            created_at TEXT,
-            FOREIGN KEY (capsule_a_id) REFERENCES capsules(id),
-            FOREIGN KEY (capsule_b_id) REFERENCES capsules(id)
-        )
-    ''')
     
-    conn.commit()
+    fresh = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'capsules'"
+    ).fetchone() is None
+    
+    with transaction(conn):
+        # 知识胶囊表
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS capsules (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                content TEXT NOT NULL,
+                source TEXT,
+                domain TEXT,
+                tags TEXT,
+                datm_score REAL,
+                author TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                metadata BLOB,
+                tag_ids BLOB
+            )
+        ''')
+        
+        # 胶囊碰撞记录表
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS collisions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                capsule_a_id TEXT,
+                capsule_b_id TEXT,
+                collision_type TEXT,
+                score REAL,
+                created_at TEXT,
+                FOREIGN KEY (capsule_a_id) REFERENCES capsules(id),
+                FOREIGN KEY (capsule_b_id) REFERENCES capsules(id)
+            )
+        ''')
+        
+        # 胶囊标签表（碰撞检测候选预筛）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS capsule_tags (
+                capsule_id TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                PRIMARY KEY (capsule_id, tag),
+                FOREIGN KEY (capsule_id) REFERENCES capsules(id)
+            )
+        ''')
+        # (tag, capsule_id) 覆盖索引：按标签查胶囊无需回表
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ct_tag_cap ON capsule_tags(tag, capsule_id)")
+        conn.execute("DROP INDEX IF EXISTS idx_capsule_tags_tag")
+        
+        # 列表查询索引：按领域/评分过滤、按创建时间倒序
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_caps_domain_score_time ON capsules(domain, datm_score DESC, created_at DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_caps_domain_time ON capsules(domain, created_at DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_caps_created ON capsules(created_at DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_collisions_a ON collisions(capsule_a_id)")
+        # 已被上面以 domain 开头的复合索引覆盖
+        conn.execute("DROP INDEX IF EXISTS idx_capsules_domain")
+        
+        # 标签词表：每个标签对应一个整数编号
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tag_vocab (
+                id INTEGER PRIMARY KEY,
+                tag TEXT NOT NULL UNIQUE
+            )
+        ''')
+        
+        migrate_db(conn, fresh)
+        load_tag_vocab(conn)
+        
+        # 缺少标签编号的胶囊（外部写入）不在 capsule_tags 中，碰撞检测经此部分索引单独取出
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_caps_untracked ON capsules(id) WHERE tag_ids IS NULL")
+
+def migrate_db(conn, fresh: bool):
+    """按 PRAGMA user_version 依次升级旧库结构"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    
+    if not fresh and version < 1:
+        # v1: 由 capsules.tags 回填 capsule_tags
+        conn.execute('''
+            INSERT OR IGNORE INTO capsule_tags (capsule_id, tag)
+            SELECT c.id, j.value FROM capsules c, json_each(c.tags) j
+            WHERE json_valid(c.tags) AND json_type(c.tags) = 'array' AND j.type = 'text'
+        ''')
+    
+    if not fresh and version < 2:
+        # v2: 新增标签编号列（由下面的 v6 回填）
+        conn.execute("ALTER TABLE capsules ADD COLUMN tag_ids BLOB")
+    
+    if not fresh and 2 <= version < 7:
+        # v7: tag_bits / tag_vocab.bit 改名，列中存的是标签编号而非位图（须先于 v6 回填）
+        conn.execute("ALTER TABLE capsules RENAME COLUMN tag_bits TO tag_ids")
+        conn.execute("ALTER TABLE tag_vocab RENAME COLUMN bit TO id")
+    
+    if not fresh and version < 3:
+        # v3: tags 由 JSON 数组改为 TAG_SEP 拼接的字符串
+        conn.execute('''
+            UPDATE capsules SET tags = (SELECT group_concat(value, char(31)) FROM json_each(capsules.tags))
+            WHERE json_valid(tags) AND json_type(tags) = 'array'
+        ''')
+    
+    if not fresh and version < 4:
+        # v4: metadata 改存 orjson 序列化的 BLOB（读取用 orjson.loads）
+        conn.execute("UPDATE capsules SET metadata = CAST(metadata AS BLOB) WHERE typeof(metadata) = 'text'")
+    
+    if not fresh and version < 6:
+        # v5: 由整段位图改为升序标签编号
+        # v6: 修复多进程各自分配编号造成的冲突（同一编号对应不同标签，或编号未登记到词表）
+        backfill_tag_ids(conn)
+    
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
 init_db()
 
 # ===================== 数据模型 =====================
+def check_tags(tags: Optional[List[str]]) -> Optional[List[str]]:
+    """标签以 TAG_SEP 拼接存储，标签本身不能包含该字符"""
+    if tags is not None and any(TAG_SEP in tag for tag in tags):
+        raise ValueError("标签不能包含分隔符 \\x1f")
+    return tags
+
 class CapsuleCreate(BaseModel):
     title: str
     content: str
@@ -76,6 +233,15 @@ class CapsuleCreate(BaseModel):
     tags: Optional[List[str]] = None
     author: Optional[str] = "Kai"
     metadata: Optional[Dict[str, Any]] = None
+    
+    _check_tags = field_validator("tags")(check_tags)
+
+class CapsuleUpdate(BaseModel):
+    title: Optional[str] = None
+    content: Optional[str] = None
+    tags: Optional[List[str]] = None
+    
+    _check_tags = field_validator("tags")(check_tags)
 
 class CapsuleResponse(BaseModel):
     id: str
@@ -85,9 +251,23 @@ class CapsuleResponse(BaseModel):
     domain: Optional[str]
     tags: Optional[List[str]]
     datm_score: Optional[float]
-    author: str
-    created_at: str
-    updated_at: str
+    author: Optional[str]
+    created_at: Optional[str]
+    updated_at: Optional[str]
+
+class Collision(BaseModel):
+    capsule_id: str
+    title: str
+    domain: Optional[str]
+    score: float
+
+class CollisionsResponse(BaseModel):
+    collisions: List[Collision]
+
+class StatsResponse(BaseModel):
+    total_capsules: int
+    avg_datm_score: float
+    domains: Dict[str, int]
 
 class CollisionRequest(BaseModel):
     capsule_id: str
@@ -97,28 +277,284 @@ class CollisionRequest(BaseModel):
 def generate_capsule_id(title: str) -> str:
     """生成胶囊ID"""
     timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    hash_val = hashlib.md5(f"{title}{timestamp}".encode()).hexdigest()[:8]
-    return f"capsule_{timestamp}_{hash_val}"
+    return f"capsule_{timestamp}_{secrets.token_hex(4)}"
+
+# 真、善、美、智 四个维度的取值区间
+_DATM_LOW = (70, 65, 60, 70)
+_DATM_HIGH = (95, 90, 85, 95)
+_rng = np.random.default_rng()
+_datm_pool: List[float] = []
 
 def calculate_datm_score(capsule: dict) -> float:
-    """计算DATM质量评分"""
-    truth = random.uniform(70, 95)
-    goodness = random.uniform(65, 90)
-    beauty = random.uniform(60, 85)
-    intelligence = random.uniform(70, 95)
-    score = (truth + goodness + beauty + intelligence) / 4
-    return round(score, 2)
+    """计算DATM质量评分（批量预生成，按需取用）"""
+    if not _datm_pool:
+        scores = _rng.uniform(_DATM_LOW, _DATM_HIGH, size=(DATM_POOL_SIZE, 4)).mean(axis=1)
+        _datm_pool.extend(np.round(scores, 2).tolist())
+    return _datm_pool.pop()
+
+def split_tags(raw: Optional[str]) -> List[str]:
+    """还原存储的标签串"""
+    return raw.split(TAG_SEP) if raw else []
+
+STOPWORDS = frozenset({
+    'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'been',
+    'being', 'have', 'has', 'had', 'do', 'does', 'did', 'will',
+    'would', 'could', 'should', 'may', 'might', 'must', 'shall',
+    'of', 'in', 'for', 'on', 'with', 'at', 'by', 'from', 'as',
+    'into', 'through', 'during', 'before', 'after', 'above'
+})
+# 长度大于3的词（\w 同时匹配中文等非ASCII文字）
+_WORD_RE = re.compile(r"\w{4,}")
 
 def extract_keywords(content: str) -> List[str]:
     """提取关键词"""
-    words = content.lower().split()
-    stopwords = {'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'been', 
-                 'being', 'have', 'has', 'had', 'do', 'does', 'did', 'will',
-                 'would', 'could', 'should', 'may', 'might', 'must', 'shall',
-                 'of', 'in', 'for', 'on', 'with', 'at', 'by', 'from', 'as',
-                 'into', 'through', 'during', 'before', 'after', 'above'}
-    keywords = [w for w in words if len(w) > 3 and w not in stopwords][:5]
-    return list(set(keywords))
+    seen = {}
+    keywords = []
+    for match in _WORD_RE.finditer(content):
+        word = match.group().lower()
+        if word not in STOPWORDS and word not in seen:
+            seen[word] = None
+            keywords.append(word)
+            if len(keywords) == 5:
+                break
+    return keywords
+
+def dump_metadata(metadata: Optional[Dict[str, Any]]) -> Optional[bytes]:
+    """序列化 metadata；orjson 无法编码的内容（如超过 64 位的整数）返回 422，保证读取端 orjson.loads 不丢精度"""
+    if not metadata:
+        return None
+    try:
+        return orjson.dumps(metadata)
+    except orjson.JSONEncodeError as e:
+        raise HTTPException(status_code=422, detail=f"metadata 无法序列化: {e}")
+
+def insert_capsules(conn, capsules: List[CapsuleCreate]) -> List[dict]:
+    """在同一个写事务内插入胶囊及其标签，返回创建结果"""
+    rows = []
+    results = []
+    with transaction(conn):
+        for capsule in capsules:
+            capsule_id = generate_capsule_id(capsule.title)
+            now = datetime.utcnow().isoformat()
+            tags = capsule.tags or extract_keywords(capsule.content)
+            datm_score = calculate_datm_score({})
+            domain = capsule.domain or "general"
+            
+            rows.append((
+                capsule_id, capsule.title, capsule.content,
+                capsule.source, domain, TAG_SEP.join(tags),
+                datm_score, capsule.author, now, now,
+                dump_metadata(capsule.metadata),
+                encode_tag_ids(conn, tags)
+            ))
+            results.append({
+                "id": capsule_id,
+                "title": capsule.title,
+                "content": capsule.content,
+                "source": capsule.source,
+                "domain": domain,
+                "tags": tags,
+                "datm_score": datm_score,
+                "author": capsule.author,
+                "created_at": now,
+                "updated_at": now
+            })
+        
+        conn.executemany(INSERT_CAPSULE_SQL, rows)
+        conn.executemany(
+            INSERT_CAPSULE_TAG_SQL,
+            [(result["id"], tag) for result in results for tag in result["tags"]]
+        )
+    return results
+
+# ===================== 响应缓存 =====================
+_response_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+def cached(ttl_seconds: float = CACHE_TTL_SECONDS):
+    """缓存只读路由的响应（按路由和查询参数区分），写操作后整体失效"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(**kwargs):
+            key = (func.__name__, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            hit = _response_cache.get(key)
+            if hit is not None and hit[0] > now:
+                _response_cache.move_to_end(key)
+                return hit[1]
+            
+            response = await func(**kwargs)
+            _response_cache[key] = (now + ttl_seconds, response)
+            _response_cache.move_to_end(key)
+            if len(_response_cache) > CACHE_MAX_ENTRIES:
+                _response_cache.popitem(last=False)
+            return response
+        return wrapper
+    return decorator
+
+def invalidate_cache():
+    """胶囊数据变更后清空响应缓存"""
+    _response_cache.clear()
+
+# ===================== 碰撞检测 =====================
+def sorted_overlap(a: List[str], b: List[str]) -> int:
+    """两个已排序、无重复标签列表的交集大小（双指针归并）"""
+    i = j = overlap = 0
+    la, lb = len(a), len(b)
+    while i < la and j < lb:
+        if a[i] == b[j]:
+            overlap += 1
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    return overlap
+
+def score_rows(rows: list, target_domain: str, target_ids: Optional[frozenset],
+               target_tags: List[str], threshold: float) -> Iterator[dict]:
+    """逐行计算候选胶囊的碰撞分数，依次产出达到阈值的碰撞"""
+    n_target = len(target_tags)
+    for id_, title, domain, raw_tags, tag_ids in rows:
+        if target_ids is not None and tag_ids is not None:
+            ids = decode_tag_ids(tag_ids)
+            overlap = len(target_ids.intersection(ids))
+            n_tags = len(ids)
+        else:
+            tags = sorted(set(split_tags(raw_tags)))
+            overlap = sorted_overlap(target_tags, tags)
+            n_tags = len(tags)
+        if overlap == 0:
+            continue
+        similarity = overlap / max(n_target, n_tags)
+        domain_bonus = 1.2 if domain == target_domain else 1.0
+        final_score = round(similarity * domain_bonus, 3)
+        
+        if final_score >= threshold:
+            yield {
+                "capsule_id": id_,
+                "title": title,
+                "domain": domain,
+                "score": final_score
+            }
+
+def score_rows_vectorized(rows: list, target_domain: str, target_ids: frozenset,
+                          threshold: float) -> Iterator[dict]:
+    """用 NumPy 一次性计算一批候选胶囊（均带 tag_ids）的碰撞分数"""
+    blobs = [row[4] for row in rows]
+    indices = np.frombuffer(b"".join(blobs), dtype="<u4")
+    counts = np.fromiter(map(len, blobs), dtype=np.intp, count=len(blobs)) // 4
+    
+    # 目标的标签在内存中展开为按编号索引的布尔掩码，候选的每个编号一次查表
+    target = np.zeros(max(max(target_ids, default=0), int(indices.max(initial=0))) + 1, dtype=bool)
+    target[list(target_ids)] = True
+    hits = np.concatenate(([0], np.cumsum(target[indices])))
+    ends = np.cumsum(counts)
+    overlap = hits[ends] - hits[ends - counts]
+    
+    same_domain = np.fromiter((row[2] == target_domain for row in rows), dtype=bool, count=len(rows))
+    raw_score = overlap / np.maximum(np.maximum(counts, len(target_ids)), 1) * np.where(same_domain, 1.2, 1.0)
+    
+    # 先用向量化条件粗筛，最终分数仍按 round(..., 3) 精确判断
+    for i in np.flatnonzero((overlap > 0) & (raw_score >= threshold - 0.0005)):
+        final_score = round(float(raw_score[i]), 3)
+        if final_score >= threshold:
+            id_, title, domain = rows[i][:3]
+            yield {
+                "capsule_id": id_,
+                "title": title,
+                "domain": domain,
+                "score": final_score
+            }
+
+def scan_collisions(conn, capsule_id: str, target_domain: str, target_ids: Optional[frozenset],
+                    target_tags: List[str], threshold: float) -> Iterator[dict]:
+    """按批比较与目标共享标签的候选胶囊，依次产出达到阈值的碰撞"""
+    n_target = len(target_tags)
+    # 分数上限为 overlap / n_target * 1.2，据此得出达到阈值所需的最少共享标签数
+    min_overlap = max(1, math.ceil((threshold - 0.0005) * n_target / 1.2 - 1e-9))
+    
+    # 只取共享标签数达到下限的胶囊，交集大小由两边的标签编号求得；
+    # 缺少标签编号的胶囊（如外部写入）没有 capsule_tags，全部取出后按有序标签列表归并求交。
+    # 目标标签取自 tags 列，目标本身缺少 capsule_tags 时同样适用
+    cursor = conn.execute('''
+        SELECT id, title, domain, tags, tag_ids FROM capsules
+        WHERE id IN (
+            SELECT capsule_id FROM capsule_tags
+            WHERE tag IN (SELECT value FROM json_each(?))
+            GROUP BY capsule_id HAVING COUNT(*) >= ?
+        ) AND id != ? AND tag_ids IS NOT NULL
+        UNION ALL
+        SELECT id, title, domain, tags, tag_ids FROM capsules
+        WHERE tag_ids IS NULL AND id != ?
+    ''', (orjson.dumps(target_tags).decode(), min_overlap, capsule_id, capsule_id))
+    
+    while rows := cursor.fetchmany(COLLISION_BATCH_SIZE):
+        tracked = [row for row in rows if row[4] is not None] if target_ids is not None else []
+        if len(tracked) >= COLLISION_VECTOR_MIN_ROWS:
+            yield from score_rows_vectorized(tracked, target_domain, target_ids, threshold)
+            rows = [row for row in rows if row[4] is None]
+        yield from score_rows(rows, target_domain, target_ids, target_tags, threshold)
+
+def row_to_capsule(row: tuple) -> dict:
+    """按列位置把 CAPSULE_COLUMNS 查询行转换为胶囊字典"""
+    id_, title, content, source, domain, tags, datm_score, author, created_at, updated_at = row
+    return {
+        "id": id_,
+        "title": title,
+        "content": content,
+        "source": source,
+        "domain": domain,
+        "tags": split_tags(tags),
+        "datm_score": datm_score,
+        "author": author,
+        "created_at": created_at,
+        "updated_at": updated_at
+    }
+
+def stream_capsules(sql: str, params: list) -> Iterator[bytes]:
+    """逐行读取并编码查询结果，不在内存中物化整个结果集"""
+    # 独立只读连接：流式响应在线程池中逐步消费，不与共享连接交错使用
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    try:
+        for row in conn.execute(sql, params):
+            yield orjson.dumps(row_to_capsule(row)) + b"\n"
+    finally:
+        conn.close()
+
+# ===================== SQL模板 =====================
+# 返回给客户端的列，顺序与 row_to_capsule() 的解包一致
+CAPSULE_COLUMNS = "id, title, content, source, domain, tags, datm_score, author, created_at, updated_at"
+INSERT_CAPSULE_SQL = '''
+    INSERT INTO capsules (id, title, content, source, domain, tags, datm_score, author, created_at, updated_at, metadata, tag_ids)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+INSERT_CAPSULE_TAG_SQL = "INSERT OR IGNORE INTO capsule_tags (capsule_id, tag) VALUES (?, ?)"
+
+# 每种字段组合（title? × content? × tags?）对应一条预生成的UPDATE语句，tags 与 tag_ids 同步更新
+_UPDATE_COLUMNS = (("title",), ("content",), ("tags", "tag_ids"))
+UPDATE_CAPSULE_SQL = {
+    flags: "UPDATE capsules SET " + ", ".join(
+        [f"{col} = ?" for cols, on in zip(_UPDATE_COLUMNS, flags) if on for col in cols] + ["updated_at = ?"]
+    ) + " WHERE id = ?"
+    for flags in itertools.product((False, True), repeat=len(_UPDATE_COLUMNS))
+}
+
+# 按过滤条件组合预先生成，保证同一形状的查询复用同一条SQL文本（命中语句缓存）
+LIST_CAPSULES_SQL = {
+    (has_domain, has_min_score): (
+        f"SELECT {CAPSULE_COLUMNS} FROM capsules WHERE 1=1"
+        + (" AND domain = ?" if has_domain else "")
+        + (" AND datm_score >= ?" if has_min_score else "")
+        + " ORDER BY created_at DESC LIMIT ?"
+    )
+    for has_domain in (False, True)
+    for has_min_score in (False, True)
+}
+# 导出不设条数上限
+EXPORT_CAPSULES_SQL = {
+    key: sql.replace(" LIMIT ?", "") for key, sql in LIST_CAPSULES_SQL.items()
+}
 
 # ===================== API路由 =====================
 
@@ -135,168 +571,134 @@ async def root():
 @app.post("/capsules", response_model=CapsuleResponse)
 async def create_capsule(capsule: CapsuleCreate):
     """创建知识胶囊"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    capsule_id = generate_capsule_id(capsule.title)
-    now = datetime.utcnow().isoformat()
-    tags = capsule.tags or extract_keywords(capsule.content)
-    datm_score = calculate_datm_score({})
-    
-    cursor.execute('''
-        INSERT INTO capsules (id, title, content, source, domain, tags, datm_score, author, created_at, updated_at, metadata)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        capsule_id, capsule.title, capsule.content,
-        capsule.source, capsule.domain or "general", json.dumps(tags),
-        datm_score, capsule.author, now, now,
-        json.dumps(capsule.metadata) if capsule.metadata else None
-    ))
-    
-    conn.commit()
-    
-    return {
-        "id": capsule_id,
-        "title": capsule.title,
-        "content": capsule.content,
-        "source": capsule.source,
-        "domain": capsule.domain or "general",
-        "tags": tags,
-        "datm_score": datm_score,
-        "author": capsule.author,
-        "created_at": now,
-        "updated_at": now
-    }
+    result = insert_capsules(get_db(), [capsule])[0]
+    invalidate_cache()
+    return result
+
+@app.post("/capsules/bulk", response_model=List[CapsuleResponse])
+async def create_capsules_bulk(capsules: List[CapsuleCreate]):
+    """批量创建知识胶囊（单个事务）"""
+    results = insert_capsules(get_db(), capsules)
+    invalidate_cache()
+    return results
 
 @app.get("/capsules", response_model=List[CapsuleResponse])
+@cached()
 async def list_capsules(domain: Optional[str] = None, min_score: Optional[float] = None, limit: int = 20):
     """查询胶囊列表"""
     conn = get_db()
-    cursor = conn.cursor()
     
-    query = "SELECT * FROM capsules WHERE 1=1"
     params = []
-    
     if domain:
-        query += " AND domain = ?"
         params.append(domain)
-    
     if min_score:
-        query += " AND datm_score >= ?"
         params.append(min_score)
-    
-    query += " ORDER BY created_at DESC LIMIT ?"
     params.append(min(limit, 100))
     
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    
-    return [{
-        "id": row['id'],
-        "title": row['title'],
-        "content": row['content'],
-        "source": row['source'],
-        "domain": row['domain'],
-        "tags": json.loads(row['tags']) if row['tags'] else [],
-        "datm_score": row['datm_score'],
-        "author": row['author'],
-        "created_at": row['created_at'],
-        "updated_at": row['updated_at']
-    } for row in rows]
+    rows = conn.execute(LIST_CAPSULES_SQL[(bool(domain), bool(min_score))], params).fetchall()
+    
+    # 由 response_model 经 Pydantic 直接序列化为 JSON 字节（FastAPI 的快速路径）
+    return [row_to_capsule(row) for row in rows]
+
+@app.get("/capsules/export")
+async def export_capsules(domain: Optional[str] = None, min_score: Optional[float] = None):
+    """按条件导出全部胶囊（NDJSON流，每行一个胶囊）"""
+    params = []
+    if domain:
+        params.append(domain)
+    if min_score:
+        params.append(min_score)
+    sql = EXPORT_CAPSULES_SQL[(bool(domain), bool(min_score))]
+    return StreamingResponse(stream_capsules(sql, params), media_type="application/x-ndjson")
 
 @app.get("/capsules/{capsule_id}", response_model=CapsuleResponse)
+@cached()
 async def get_capsule(capsule_id: str):
     """获取单个胶囊"""
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM capsules WHERE id = ?", (capsule_id,))
-    row = cursor.fetchone()
+    row = conn.execute(f"SELECT {CAPSULE_COLUMNS} FROM capsules WHERE id = ?", (capsule_id,)).fetchone()
     
     if row is None:
         raise HTTPException(status_code=404, detail="胶囊不存在")
     
-    return {
-        "id": row['id'],
-        "title": row['title'],
-        "content": row['content'],
-        "source": row['source'],
-        "domain": row['domain'],
-        "tags": json.loads(row['tags']) if row['tags'] else [],
-        "datm_score": row['datm_score'],
-        "author": row['author'],
-        "created_at": row['created_at'],
-        "updated_at": row['updated_at']
-    }
+    return row_to_capsule(row)
+
+@app.put("/capsules/{capsule_id}", response_model=CapsuleResponse)
+async def update_capsule(capsule_id: str, capsule: CapsuleUpdate):
+    """更新胶囊（只修改提供的字段）"""
+    conn = get_db()
+    now = datetime.utcnow().isoformat()
+    flags = (capsule.title is not None, capsule.content is not None, capsule.tags is not None)
+    
+    with transaction(conn):
+        params = [v for v in (capsule.title, capsule.content) if v is not None]
+        if capsule.tags is not None:
+            params.append(TAG_SEP.join(capsule.tags))
+            params.append(encode_tag_ids(conn, capsule.tags))
+        params.append(now)
+        params.append(capsule_id)
+        
+        if conn.execute(UPDATE_CAPSULE_SQL[flags], params).rowcount == 0:
+            raise HTTPException(status_code=404, detail="胶囊不存在")
+        
+        if capsule.tags is not None:
+            conn.execute("DELETE FROM capsule_tags WHERE capsule_id = ?", (capsule_id,))
+            conn.executemany(INSERT_CAPSULE_TAG_SQL, [(capsule_id, tag) for tag in capsule.tags])
+        
+        row = conn.execute(f"SELECT {CAPSULE_COLUMNS} FROM capsules WHERE id = ?", (capsule_id,)).fetchone()
+    
+    invalidate_cache()
+    return row_to_capsule(row)
 
 @app.delete("/capsules/{capsule_id}")
 async def delete_capsule(capsule_id: str):
     """删除胶囊"""
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM capsules WHERE id = ?", (capsule_id,))
-    conn.commit()
+    with transaction(conn):
+        deleted = conn.execute("DELETE FROM capsules WHERE id = ?", (capsule_id,)).rowcount
+        conn.execute("DELETE FROM capsule_tags WHERE capsule_id = ?", (capsule_id,))
     
-    if cursor.rowcount == 0:
+    if deleted == 0:
         raise HTTPException(status_code=404, detail="胶囊不存在")
     
+    invalidate_cache()
     return {"status": "deleted", "id": capsule_id}
 
-@app.get("/collisions/{capsule_id}")
-async def detect_collisions(capsule_id: str, threshold: float = 0.5):
-    """碰撞检测"""
+@app.get("/collisions/{capsule_id}", response_model=CollisionsResponse)
+@cached()
+async def detect_collisions(capsule_id: str, threshold: float = Query(0.5, gt=0)):
+    """碰撞检测（只比较共享标签的胶囊，threshold 须大于 0）"""
     conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM capsules WHERE id = ?", (capsule_id,))
-    target = cursor.fetchone()
+    target = conn.execute("SELECT domain, tags, tag_ids FROM capsules WHERE id = ?", (capsule_id,)).fetchone()
     
     if target is None:
         raise HTTPException(status_code=404, detail="胶囊不存在")
     
-    target_tags = set(json.loads(target['tags']) if target['tags'] else [])
-    target_domain = target['domain']
+    target_domain, raw_tags, tag_ids = target
+    target_tags = sorted(set(split_tags(raw_tags)))
+    target_ids = frozenset(decode_tag_ids(tag_ids)) if tag_ids is not None else None
     
-    cursor.execute("SELECT * FROM capsules WHERE id != ?", (capsule_id,))
-    all_capsules = cursor.fetchall()
+    collisions = scan_collisions(conn, capsule_id, target_domain, target_ids, target_tags, threshold)
     
-    collisions = []
-    for capsule in all_capsules:
-        capsule_tags = set(json.loads(capsule['tags']) if capsule['tags'] else [])
-        
-        if target_tags and capsule_tags:
-            overlap = len(target_tags & capsule_tags)
-            similarity = overlap / max(len(target_tags), len(capsule_tags))
-        else:
-            similarity = 0
-        
-        domain_bonus = 1.2 if capsule['domain'] == target_domain else 1.0
-        final_score = round(similarity * domain_bonus, 3)
-        
-        if final_score >= threshold:
-            collisions.append({
-                "capsule_id": capsule['id'],
-                "title": capsule['title'],
-                "domain": capsule['domain'],
-                "score": final_score
-            })
-    
-    collisions.sort(key=lambda x: x['score'], reverse=True)
-    return {"collisions": collisions[:20]}
+    # 只保留前20个，不物化全部候选
+    return {"collisions": heapq.nlargest(20, collisions, key=lambda x: x['score'])}
 
-@app.get("/stats")
+@app.get("/stats", response_model=StatsResponse)
+@cached()
 async def get_stats():
     """统计信息"""
     conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) FROM capsules")
-    total = cursor.fetchone()[0]
     
-    cursor.execute("SELECT AVG(datm_score) FROM capsules")
-    avg_score = cursor.fetchone()[0] or 0
+    # 一次分组查询（走 domain, datm_score 覆盖索引），总数和均分由各组汇总得出
+    rows = conn.execute('''
+        SELECT domain, COUNT(*), SUM(datm_score), COUNT(datm_score)
+        FROM capsules GROUP BY domain
+    ''').fetchall()
     
-    cursor.execute("SELECT domain, COUNT(*) FROM capsules GROUP BY domain")
-    domains = {row['domain']: row[1] for row in cursor.fetchall()}
+    domains = {row[0]: row[1] for row in rows}
+    total = sum(domains.values())
+    scored = sum(row[3] for row in rows)
+    avg_score = sum(row[2] or 0 for row in rows) / scored if scored else 0
     
     return {"total_capsules": total, "avg_datm_score": round(avg_score, 2), "domains": domains}
 
@@ -0,0 +1,207 @@
+"""
+知识胶囊服务测试
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+os.environ["CAPSULE_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "capsules.db")
+
+import orjson
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+def create(title, tags, domain="ai", **extra):
+    response = client.post("/capsules", json={"title": title, "content": "内容", "domain": domain, "tags": tags, **extra})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_tag_ids_size_follows_own_tags():
+    """tag_ids 大小只取决于自身标签数，而非词表规模"""
+    for i in range(200):
+        create(f"filler{i}", [f"filler-tag-{i}"])
+    capsule = create("compact", ["compact-a", "compact-b", "compact-c"])
+    
+    blob = main.get_db().execute("SELECT tag_ids FROM capsules WHERE id = ?", (capsule["id"],)).fetchone()[0]
+    assert len(blob) == 3 * 4
+    assert sorted(main.decode_tag_ids(blob)) == sorted(main._tag_vocab[t] for t in ["compact-a", "compact-b", "compact-c"])
+
+
+def test_tag_vocab_shared_between_processes():
+    """多个进程共用一个库时，新标签的编号不冲突"""
+    create("mp-warm", ["mp-warm"])
+    other_process = (
+        "from fastapi.testclient import TestClient; import main; "
+        "r = TestClient(main.app).post('/capsules', json={'title': 'mp-q', 'content': '内容', 'domain': 'ai', "
+        "'tags': ['mp-quantum', 'mp-shared']}); assert r.status_code == 200, r.text; print(r.json()['id'])"
+    )
+    result = subprocess.run([sys.executable, "-c", other_process], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=os.environ)
+    assert result.returncode == 0, result.stderr
+    quantum_id = result.stdout.split()[-1]
+    cooking = create("mp-c", ["mp-cooking", "mp-shared"])
+    
+    vocab = dict(main.get_db().execute("SELECT tag, id FROM tag_vocab").fetchall())
+    assert vocab["mp-quantum"] != vocab["mp-cooking"]
+    response = client.get(f"/collisions/{cooking['id']}", params={"threshold": 0.1})
+    assert {"capsule_id": quantum_id, "title": "mp-q", "domain": "ai", "score": 0.6} in response.json()["collisions"]
+
+
+def test_vectorized_scoring_matches_row_scoring():
+    """向量化计分与逐行计分结果一致"""
+    import random
+    rng = random.Random(7)
+    vocab = [f"vec-{i}" for i in range(40)]
+    for i in range(400):
+        create(f"vec{i}", rng.sample(vocab, rng.randint(1, 6)), domain=rng.choice(["ai", "bio"]))
+    
+    conn = main.get_db()
+    rows = conn.execute("SELECT id, title, domain, tags, tag_ids FROM capsules WHERE title LIKE 'vec%'").fetchall()
+    assert len(rows) >= main.COLLISION_VECTOR_MIN_ROWS
+    for _, _, domain, raw_tags, tag_ids in rows[:20]:
+        target_ids = frozenset(main.decode_tag_ids(tag_ids))
+        target_tags = sorted(set(main.split_tags(raw_tags)))
+        for threshold in (0.1, 0.5, 0.9):
+            expected = list(main.score_rows(rows, domain, target_ids, target_tags, threshold))
+            actual = list(main.score_rows_vectorized(rows, domain, target_ids, threshold))
+            assert actual == expected
+
+
+def test_collisions_include_rows_without_tag_ids():
+    """外部写入、缺少 tag_ids 与 capsule_tags 的胶囊仍参与碰撞检测"""
+    tracked = create("raw-pair", ["raw-p", "raw-q"], domain="raw-a")
+    conn = main.get_db()
+    conn.execute(
+        "INSERT INTO capsules (id, title, content, domain, tags) VALUES (?, ?, ?, ?, ?)",
+        ("rawonly1", "raw-only", "内容", "raw-b", "raw-p"),
+    )
+    main.invalidate_cache()
+    
+    response = client.get(f"/collisions/{tracked['id']}", params={"threshold": 0.1})
+    assert {"capsule_id": "rawonly1", "title": "raw-only", "domain": "raw-b", "score": 0.5} in response.json()["collisions"]
+    
+    response = client.get("/collisions/rawonly1", params={"threshold": 0.1})
+    assert response.json()["collisions"] == [
+        {"capsule_id": tracked["id"], "title": "raw-pair", "domain": "raw-a", "score": 0.5}
+    ]
+
+
+def test_metadata_with_big_int_rejected():
+    """超过 64 位的整数 metadata 返回 422，不写入任何数据"""
+    response = client.post("/capsules", json={"title": "big-int", "content": "内容", "tags": ["big-int"], "metadata": {"n": 2 ** 70}})
+    assert response.status_code == 422
+    
+    response = client.post("/capsules/bulk", json=[
+        {"title": "big-ok", "content": "内容", "tags": ["big-int"]},
+        {"title": "big-int", "content": "内容", "tags": ["big-int"], "metadata": {"n": 2 ** 70}},
+    ])
+    assert response.status_code == 422
+    assert main.get_db().execute("SELECT COUNT(*) FROM capsules WHERE title LIKE 'big-%'").fetchone()[0] == 0
+    
+    created = create("big-small", ["big-int"], metadata={"n": 2 ** 63 - 1})
+    blob = main.get_db().execute("SELECT metadata FROM capsules WHERE id = ?", (created["id"],)).fetchone()[0]
+    assert orjson.loads(blob) == {"n": 2 ** 63 - 1}
+
+
+def test_tag_with_separator_rejected():
+    """标签包含 TAG_SEP 时创建和更新均返回 422"""
+    response = client.post("/capsules", json={"title": "sep", "content": "内容", "tags": ["sep-a\x1fsep-b"]})
+    assert response.status_code == 422
+    
+    capsule = create("sep", ["sep-a"])
+    response = client.put(f"/capsules/{capsule['id']}", json={"tags": ["sep-a\x1fsep-b"]})
+    assert response.status_code == 422
+    assert client.get(f"/capsules/{capsule['id']}").json()["tags"] == ["sep-a"]
+
+
+def test_collision_threshold_must_be_positive():
+    """threshold <= 0 返回 422，而不是静默忽略零分胶囊"""
+    capsule = create("th", ["th-a"])
+    for threshold in (0, -1):
+        response = client.get(f"/collisions/{capsule['id']}", params={"threshold": threshold})
+        assert response.status_code == 422
+
+
+def test_update_tags_visible_to_collisions():
+    """更新标签后碰撞检测立即反映新标签，不返回缓存的旧结果"""
+    a = create("up-a", ["up-x", "up-y"])
+    b = create("up-b", ["up-x", "up-y"])
+    response = client.get(f"/collisions/{a['id']}")
+    assert [c["capsule_id"] for c in response.json()["collisions"]] == [b["id"]]
+    
+    response = client.put(f"/capsules/{b['id']}", json={"tags": ["up-z"]})
+    assert response.status_code == 200
+    assert response.json()["tags"] == ["up-z"]
+    
+    assert client.get(f"/collisions/{a['id']}").json()["collisions"] == []
+    assert client.get(f"/capsules/{b['id']}").json()["tags"] == ["up-z"]
+    rows = main.get_db().execute("SELECT tag FROM capsule_tags WHERE capsule_id = ?", (b["id"],)).fetchall()
+    assert rows == [("up-z",)]
+
+
+def test_update_missing_capsule_leaves_no_rows():
+    """更新不存在的胶囊返回 404，事务回滚后不留下词表和标签行"""
+    response = client.put("/capsules/up-missing", json={"tags": ["up-ghost"]})
+    assert response.status_code == 404
+    
+    conn = main.get_db()
+    assert conn.execute("SELECT COUNT(*) FROM tag_vocab WHERE tag = 'up-ghost'").fetchone()[0] == 0
+    assert conn.execute(
+        "SELECT COUNT(*) FROM capsule_tags WHERE capsule_id = 'up-missing' OR tag = 'up-ghost'"
+    ).fetchone()[0] == 0
+    
+    # 回滚后新标签重新登记，编号与词表一致
+    capsule = create("up-ghost", ["up-ghost"])
+    blob = conn.execute("SELECT tag_ids FROM capsules WHERE id = ?", (capsule["id"],)).fetchone()[0]
+    assert main.decode_tag_ids(blob) == conn.execute("SELECT id FROM tag_vocab WHERE tag = 'up-ghost'").fetchone()
+
+
+def test_bulk_create():
+    """批量创建写入胶囊与标签，并使列表缓存失效"""
+    assert client.get("/capsules", params={"domain": "bulk"}).json() == []
+    
+    response = client.post("/capsules/bulk", json=[
+        {"title": "bulk-a", "content": "内容", "domain": "bulk", "tags": ["bulk-x", "bulk-y"]},
+        {"title": "bulk-b", "content": "内容", "domain": "bulk", "tags": ["bulk-x"]},
+    ])
+    assert response.status_code == 200
+    created = response.json()
+    assert [c["title"] for c in created] == ["bulk-a", "bulk-b"]
+    
+    listed = client.get("/capsules", params={"domain": "bulk"}).json()
+    assert {c["id"] for c in listed} == {c["id"] for c in created}
+    rows = main.get_db().execute(
+        "SELECT capsule_id, tag FROM capsule_tags WHERE tag LIKE 'bulk-%' ORDER BY capsule_id, tag"
+    ).fetchall()
+    assert sorted(rows) == sorted([(created[0]["id"], "bulk-x"), (created[0]["id"], "bulk-y"), (created[1]["id"], "bulk-x")])
+    
+    response = client.get(f"/collisions/{created[1]['id']}")
+    assert response.json()["collisions"] == [
+        {"capsule_id": created[0]["id"], "title": "bulk-a", "domain": "bulk", "score": 0.6}
+    ]
+
+
+def test_export_streams_all_matching_capsules():
+    """导出按条件返回全部胶囊（不受列表 100 条上限限制），每行一个 JSON 对象"""
+    response = client.post("/capsules/bulk", json=[
+        {"title": f"export-{i}", "content": "内容", "domain": "export", "tags": ["export-a", f"export-{i}"]}
+        for i in range(105)
+    ])
+    assert response.status_code == 200
+    created = {c["id"]: c for c in response.json()}
+    
+    response = client.get("/capsules/export", params={"domain": "export"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    exported = [orjson.loads(line) for line in response.content.splitlines()]
+    assert len(exported) == 105
+    assert {c["id"]: c for c in exported} == created
+    
+    response = client.get("/capsules/export", params={"domain": "export", "min_score": 101})
+    assert response.content == b""